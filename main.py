@@ -16,22 +16,30 @@ if sys.version_info >= (3, 13):
 
 # Теперь импортируем остальные модули
 import requests
-from bs4 import BeautifulSoup
-import hashlib
+import httpx
+import lxml.html
+from lxml import etree
+import xxhash
 import time
 import json
-import schedule
 import logging
 from datetime import datetime
 import difflib
 import re
 import sqlite3
+import copy
+import ssl
+import zlib
+import string
 from contextlib import contextmanager
+from pathlib import Path
+from queue import Queue, Empty
 from telegram import Bot, Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import Application, CommandHandler, CallbackQueryHandler, ContextTypes
 import asyncio
-from threading import Thread, Lock
-from collections import defaultdict
+from threading import Thread, Lock, RLock
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
 import random
 import traceback
 from urllib.parse import urlparse
@@ -55,11 +63,142 @@ logger = logging.getLogger(__name__)
 
 # ==================== БАЗА ДАННЫХ ====================
 
+# Режим журнала хранится в самом файле БД: его достаточно включить один раз
+# с соединения писателя, соединения только на чтение его и не могут сменить
+_WRITER_PRAGMAS = 'PRAGMA journal_mode=WAL;'
+
+# Выполняется один раз при открытии каждого соединения, а не на каждый запрос
+_CONNECTION_PRAGMAS = '''
+    PRAGMA synchronous=NORMAL;
+    PRAGMA cache_size=-64000;
+    PRAGMA temp_store=MEMORY;
+    PRAGMA mmap_size=268435456;
+    PRAGMA busy_timeout=5000;
+'''
+
+# Версия формата хранимого текста страниц (PRAGMA user_version)
+_TEXT_FORMAT_VERSION = 1
+
+# Запросы вынесены в константы: один и тот же текст попадает в кэш
+# подготовленных выражений соединения и не разбирается заново
+_SQL_GET_USER = 'SELECT * FROM users WHERE user_id = ?'
+_SQL_CREATE_USER = 'INSERT OR IGNORE INTO users (user_id, username, first_name) VALUES (?, ?, ?)'
+_SQL_SET_SUBSCRIBED = 'UPDATE users SET subscribed = ? WHERE user_id = ?'
+_SQL_ADD_SITE = '''
+    INSERT INTO monitored_sites (user_id, url, site_name, css_selector, domain)
+    VALUES (?, ?, ?, ?, ?)
+'''
+_SQL_GET_USER_SITES = 'SELECT * FROM monitored_sites WHERE user_id = ? AND enabled = 1'
+_SQL_GET_SUBSCRIBED_USERS = 'SELECT * FROM users WHERE subscribed = 1'
+# Без текста страницы: он нужен только при найденном изменении (_SQL_GET_SITE_CONTENT)
+_SQL_GET_DUE_SITES = '''
+    SELECT ms.id, ms.user_id, ms.url, ms.domain, ms.site_name, ms.last_hash, ms.body_hash,
+           ms.etag, ms.last_modified, u.username, u.first_name
+    FROM monitored_sites ms
+    JOIN users u ON ms.user_id = u.user_id
+    WHERE u.subscribed = 1 AND ms.enabled = 1
+    AND (ms.next_check_at IS NULL OR ms.next_check_at <= CURRENT_TIMESTAMP)
+'''
+_SQL_GET_STATUS_COUNTS = '''
+    SELECT
+        (SELECT subscribed FROM users WHERE user_id = ?) AS subscribed,
+        COUNT(CASE WHEN user_id = ? THEN 1 END) AS user_sites,
+        COUNT(*) AS total_sites
+    FROM monitored_sites
+    WHERE enabled = 1
+'''
+_SQL_GET_SITE_CONTENT = 'SELECT last_content, last_content_compressed FROM monitored_sites WHERE id = ?'
+_SQL_DELETE_SITE = 'DELETE FROM monitored_sites WHERE id = ? AND user_id = ?'
+_SQL_UPDATE_SITE_HASH = '''
+    UPDATE monitored_sites
+    SET last_hash = ?, body_hash = ?, last_content = NULL, last_content_compressed = ?,
+        last_checked = CURRENT_TIMESTAMP,
+        next_check_at = datetime('now', '+' || check_interval || ' minutes')
+    WHERE id = ?
+'''
+_SQL_UPDATE_CACHE_HEADERS = 'UPDATE monitored_sites SET etag = ?, last_modified = ? WHERE id = ?'
+_SQL_TOUCH_SITE = '''
+    UPDATE monitored_sites
+    SET last_checked = CURRENT_TIMESTAMP,
+        next_check_at = datetime('now', '+' || check_interval || ' minutes')
+    WHERE id = ?
+'''
+_SQL_RECORD_ERROR = 'INSERT INTO check_errors (site_id, error_type, error_message) VALUES (?, ?, ?)'
+_SQL_GET_PREFERENCES = 'SELECT * FROM user_preferences WHERE user_id = ?'
+_SQL_UPSERT_PREFERENCES = '''
+    INSERT INTO user_preferences
+    (user_id, preferred_categories, notification_frequency,
+     weight_content, weight_design, weight_technical, positive_feedback, negative_feedback)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT(user_id) DO UPDATE SET
+        preferred_categories = excluded.preferred_categories,
+        notification_frequency = excluded.notification_frequency,
+        weight_content = excluded.weight_content,
+        weight_design = excluded.weight_design,
+        weight_technical = excluded.weight_technical,
+        positive_feedback = excluded.positive_feedback,
+        negative_feedback = excluded.negative_feedback,
+        updated_at = CURRENT_TIMESTAMP
+'''
+_SQL_RECORD_PATTERN = '''
+    INSERT INTO learned_patterns (user_id, category, importance, likes, dislikes)
+    VALUES (?, ?, ?, ?, ?)
+    ON CONFLICT(user_id, category, importance) DO UPDATE SET
+        likes = likes + excluded.likes,
+        dislikes = dislikes + excluded.dislikes
+'''
+_SQL_GET_TRAINED_PATTERNS = '''
+    SELECT category, likes, dislikes FROM learned_patterns
+    WHERE user_id = ? AND likes + dislikes >= 3
+'''
+_SQL_RECORD_FEEDBACK = '''
+    INSERT INTO user_feedback (user_id, notification_id, feedback_type, change_category, importance_level)
+    VALUES (?, ?, ?, ?, ?)
+'''
+_SQL_MARK_FEEDBACK_RECEIVED = '''
+    UPDATE notification_history SET feedback_received = TRUE
+    WHERE notification_id = ? AND user_id = ?
+'''
+_SQL_SAVE_NOTIFICATION = '''
+    INSERT INTO notification_history (user_id, notification_id, site_name, change_category, importance_level)
+    VALUES (?, ?, ?, ?, ?)
+'''
+_SQL_GET_NOTIFICATION = 'SELECT * FROM notification_history WHERE notification_id = ? AND user_id = ?'
+
+
+def _unpack_content(compressed, legacy):
+    """Текст страницы из сжатой колонки; у строк, не обновлявшихся после
+    перехода на сжатие, он еще лежит в last_content"""
+    if compressed is not None:
+        return zlib.decompress(compressed).decode('utf-8')
+    legacy = legacy or ''
+    return legacy if isinstance(legacy, str) else str(legacy)
+
+
 class DatabaseManager:
-    def __init__(self, db_path="monitoring.db"):
+    def __init__(self, db_path="monitoring.db", pool_size=4):
         self.db_path = db_path
-        self.lock = Lock()
+        self._write_lock = Lock()
+        # Одно долгоживущее соединение на запись (под блокировкой) + пул соединений
+        # только на чтение: в режиме WAL читатели не ждут писателя и друг друга
+        self._writer = self._connect()
         self.init_database()
+        self._readers = Queue(maxsize=pool_size)
+        for _ in range(pool_size):
+            self._readers.put(self._connect(read_only=True))
+        self.write_queue = WriteQueue(self)
+
+    def _connect(self, read_only=False):
+        if read_only:
+            uri = f"{Path(self.db_path).resolve().as_uri()}?mode=ro"
+            conn = sqlite3.connect(uri, uri=True, check_same_thread=False, cached_statements=256)
+        else:
+            conn = sqlite3.connect(self.db_path, check_same_thread=False, cached_statements=256)
+        conn.row_factory = sqlite3.Row
+        if not read_only:
+            conn.executescript(_WRITER_PRAGMAS)
+        conn.executescript(_CONNECTION_PRAGMAS)
+        return conn
 
     def init_database(self):
         with self.get_connection() as conn:
@@ -81,7 +220,7 @@ class DatabaseManager:
                     url TEXT NOT NULL,
                     site_name TEXT,
                     css_selector TEXT,
-                    last_hash TEXT,
+                    last_hash BLOB,
                     last_content TEXT,
                     check_interval INTEGER DEFAULT 10,
                     enabled INTEGER DEFAULT 1,
@@ -144,12 +283,97 @@ class DatabaseManager:
                 )
             ''')
 
+            # Время следующей проверки хранится готовым, чтобы фильтр планировщика шел по индексу
+            self._ensure_column(conn, 'monitored_sites', 'next_check_at', 'TIMESTAMP')
+            conn.execute('''
+                UPDATE monitored_sites
+                SET next_check_at = datetime(last_checked, '+' || check_interval || ' minutes')
+                WHERE next_check_at IS NULL AND last_checked IS NOT NULL
+            ''')
+            # Хэш сырого тела ответа: совпал - страницу можно не разбирать
+            self._ensure_column(conn, 'monitored_sites', 'body_hash', 'BLOB')
+            # Валидаторы кэша для условных GET-запросов
+            self._ensure_column(conn, 'monitored_sites', 'etag', 'TEXT')
+            self._ensure_column(conn, 'monitored_sites', 'last_modified', 'TEXT')
+            # Текст страницы хранится сжатым zlib; last_content обнуляется при следующей записи
+            self._ensure_column(conn, 'monitored_sites', 'last_content_compressed', 'BLOB')
+            # Хост разбирается из URL один раз при добавлении сайта, а не на каждой проверке
+            self._ensure_column(conn, 'monitored_sites', 'domain', 'TEXT')
+            missing_domains = conn.execute(
+                'SELECT id, url FROM monitored_sites WHERE domain IS NULL'
+            ).fetchall()
+            conn.executemany(
+                'UPDATE monitored_sites SET domain = ? WHERE id = ?',
+                [(urlparse(row['url']).netloc, row['id']) for row in missing_domains]
+            )
+
+            # Версия 1: текст страницы хранится с переводами строк между блоками.
+            # Хэши, посчитанные по старому однострочному тексту, сбрасываются -
+            # сайты получают новый хэш на следующей проверке без ложного уведомления
+            if conn.execute('PRAGMA user_version').fetchone()[0] < _TEXT_FORMAT_VERSION:
+                conn.execute('UPDATE monitored_sites SET last_hash = NULL, body_hash = NULL')
+                conn.execute(f'PRAGMA user_version = {_TEXT_FORMAT_VERSION}')
+
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS learned_patterns (
+                    user_id INTEGER,
+                    category TEXT,
+                    importance TEXT,
+                    likes INTEGER DEFAULT 0,
+                    dislikes INTEGER DEFAULT 0,
+                    PRIMARY KEY (user_id, category, importance)
+                )
+            ''')
+
+            # Веса и счетчики обратной связи хранятся в отдельных колонках, а не в JSON.
+            # Колонки importance_weights/learning_data остаются только для миграции
+            self._ensure_column(conn, 'user_preferences', 'weight_content', 'REAL')
+            self._ensure_column(conn, 'user_preferences', 'weight_design', 'REAL')
+            self._ensure_column(conn, 'user_preferences', 'weight_technical', 'REAL')
+            self._ensure_column(conn, 'user_preferences', 'positive_feedback', 'INTEGER')
+            self._ensure_column(conn, 'user_preferences', 'negative_feedback', 'INTEGER')
+            self._migrate_preferences_json(conn)
+
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_sites_enabled_next_check ON monitored_sites(enabled, next_check_at)')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_sites_user ON monitored_sites(user_id, enabled)')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_users_subscribed ON users(subscribed) WHERE subscribed = 1')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_notif_history_lookup ON notification_history(notification_id, user_id)')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_feedback_user ON user_feedback(user_id, notification_id)')
+
+    def _migrate_preferences_json(self, conn):
+        rows = conn.execute('''
+            SELECT user_id, importance_weights, learning_data FROM user_preferences
+            WHERE weight_content IS NULL
+        ''').fetchall()
+
+        for row in rows:
+            weights = json.loads(row['importance_weights'])
+            learning_data = json.loads(row['learning_data'])
+            conn.execute('''
+                UPDATE user_preferences
+                SET weight_content = ?, weight_design = ?, weight_technical = ?,
+                    positive_feedback = ?, negative_feedback = ?
+                WHERE user_id = ?
+            ''', (
+                weights.get('content', 1.0), weights.get('design', 0.7), weights.get('technical', 0.3),
+                learning_data.get('positive_feedback', 0), learning_data.get('negative_feedback', 0),
+                row['user_id']
+            ))
+            for key, feedback in learning_data.get('learned_patterns', {}).items():
+                category, _, importance = key.partition('_')
+                conn.execute(_SQL_RECORD_PATTERN, (
+                    row['user_id'], category, importance, feedback['likes'], feedback['dislikes']
+                ))
+
+    def _ensure_column(self, conn, table, column, definition):
+        columns = {row['name'] for row in conn.execute(f'PRAGMA table_info({table})')}
+        if column not in columns:
+            conn.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
+
     @contextmanager
     def get_connection(self):
-        with self.lock:
-            conn = sqlite3.connect(self.db_path, timeout=30.0)
-            conn.row_factory = sqlite3.Row
-            conn.execute("PRAGMA journal_mode=WAL")
+        with self._write_lock:
+            conn = self._writer
             try:
                 yield conn
                 conn.commit()
@@ -157,247 +381,426 @@ class DatabaseManager:
                 conn.rollback()
                 logger.error(f"Database error: {e}")
                 raise
-            finally:
-                conn.close()
+
+    @contextmanager
+    def get_read_connection(self):
+        conn = self._readers.get(timeout=30.0)
+        try:
+            yield conn
+        except Exception as e:
+            logger.error(f"Database error: {e}")
+            raise
+        finally:
+            self._readers.put(conn)
+
+    def close(self):
+        """Дописывает очередь фоновых записей и закрывает все соединения"""
+        self.write_queue.flush()
+        while True:
+            try:
+                self._readers.get_nowait().close()
+            except Empty:
+                break
+        with self._write_lock:
+            # Обновляет статистику планировщика запросов для таблиц, где это нужно
+            self._writer.execute('PRAGMA optimize')
+            self._writer.close()
 
     def get_user(self, user_id):
-        with self.get_connection() as conn:
-            return conn.execute(
-                'SELECT * FROM users WHERE user_id = ?', (user_id,)
-            ).fetchone()
+        with self.get_read_connection() as conn:
+            return conn.execute(_SQL_GET_USER, (user_id,)).fetchone()
 
     def create_user(self, user_id, username, first_name):
         with self.get_connection() as conn:
-            conn.execute(
-                'INSERT OR IGNORE INTO users (user_id, username, first_name) VALUES (?, ?, ?)',
-                (user_id, username, first_name)
-            )
+            conn.execute(_SQL_CREATE_USER, (user_id, username, first_name))
 
     def subscribe_user(self, user_id):
         with self.get_connection() as conn:
-            conn.execute(
-                'UPDATE users SET subscribed = 1 WHERE user_id = ?', (user_id,)
-            )
+            conn.execute(_SQL_SET_SUBSCRIBED, (1, user_id))
 
     def unsubscribe_user(self, user_id):
         with self.get_connection() as conn:
-            conn.execute(
-                'UPDATE users SET subscribed = 0 WHERE user_id = ?', (user_id,)
-            )
+            conn.execute(_SQL_SET_SUBSCRIBED, (0, user_id))
 
     def add_monitored_site(self, user_id, url, site_name, css_selector=None):
         with self.get_connection() as conn:
             try:
-                conn.execute(
-                    '''INSERT INTO monitored_sites 
-                    (user_id, url, site_name, css_selector) 
-                    VALUES (?, ?, ?, ?)''',
-                    (user_id, url, site_name, css_selector)
-                )
+                conn.execute(_SQL_ADD_SITE, (user_id, url, site_name, css_selector, urlparse(url).netloc))
                 return True
             except sqlite3.IntegrityError:
                 logger.warning(f"Site {url} already exists for user {user_id}")
                 return False
 
     def get_user_sites(self, user_id):
-        with self.get_connection() as conn:
-            return conn.execute(
-                'SELECT * FROM monitored_sites WHERE user_id = ? AND enabled = 1', (user_id,)
-            ).fetchall()
+        with self.get_read_connection() as conn:
+            return conn.execute(_SQL_GET_USER_SITES, (user_id,)).fetchall()
 
     def get_all_subscribed_users(self):
-        with self.get_connection() as conn:
-            return conn.execute(
-                'SELECT * FROM users WHERE subscribed = 1'
-            ).fetchall()
+        with self.get_read_connection() as conn:
+            return conn.execute(_SQL_GET_SUBSCRIBED_USERS).fetchall()
 
     def get_all_monitored_sites(self):
-        with self.get_connection() as conn:
-            return conn.execute('''
-                SELECT ms.*, u.username, u.first_name 
-                FROM monitored_sites ms 
-                JOIN users u ON ms.user_id = u.user_id 
-                WHERE u.subscribed = 1 AND ms.enabled = 1
-                AND (ms.last_checked IS NULL OR 
-                     datetime(ms.last_checked, '+' || ms.check_interval || ' minutes') < datetime('now'))
-            ''').fetchall()
+        with self.get_read_connection() as conn:
+            return conn.execute(_SQL_GET_DUE_SITES).fetchall()
+
+    def get_site_content(self, site_id):
+        """Сохраненный текст страницы (распакованный)"""
+        with self.get_read_connection() as conn:
+            row = conn.execute(_SQL_GET_SITE_CONTENT, (site_id,)).fetchone()
+        if row is None:
+            return ''
+        return _unpack_content(row['last_content_compressed'], row['last_content'])
+
+    def get_status_counts(self, user_id):
+        """Подписка пользователя, число его сайтов и сайтов в системе одним запросом"""
+        with self.get_read_connection() as conn:
+            row = conn.execute(_SQL_GET_STATUS_COUNTS, (user_id, user_id)).fetchone()
+            return bool(row['subscribed']), row['user_sites'], row['total_sites']
 
     def delete_site(self, user_id, site_id):
         with self.get_connection() as conn:
-            conn.execute(
-                'DELETE FROM monitored_sites WHERE id = ? AND user_id = ?',
-                (site_id, user_id)
-            )
-            return conn.total_changes > 0
+            cursor = conn.execute(_SQL_DELETE_SITE, (site_id, user_id))
+            return cursor.rowcount > 0
 
-    def update_site_hash(self, site_id, current_hash, content):
+    def update_site_hash(self, site_id, current_hash, body_hash, content):
+        # Сжатие до захвата блокировки писателя
+        compressed = zlib.compress(content[:100000].encode('utf-8'))
         with self.get_connection() as conn:
-            conn.execute(
-                '''UPDATE monitored_sites 
-                SET last_hash = ?, last_content = ?, last_checked = CURRENT_TIMESTAMP 
-                WHERE id = ?''',
-                (current_hash, content[:100000], site_id)
-            )
+            conn.execute(_SQL_UPDATE_SITE_HASH, (current_hash, body_hash, compressed, site_id))
+
+    def touch_site(self, site_id):
+        """Отмечает проверку сайта, содержимое которого не изменилось"""
+        with self.get_connection() as conn:
+            conn.execute(_SQL_TOUCH_SITE, (site_id,))
+
+    def update_site_cache_headers(self, site_id, etag, last_modified):
+        with self.get_connection() as conn:
+            conn.execute(_SQL_UPDATE_CACHE_HEADERS, (etag, last_modified, site_id))
 
     def record_error(self, site_id, error_type, error_message):
         with self.get_connection() as conn:
-            conn.execute(
-                '''INSERT INTO check_errors (site_id, error_type, error_message)
-                VALUES (?, ?, ?)''',
+            conn.execute(_SQL_RECORD_ERROR, (site_id, error_type, error_message[:500]))
+
+    def record_errors_bulk(self, errors):
+        """Записывает список (site_id, тип, сообщение) одной транзакцией"""
+        if not errors:
+            return
+        with self.get_connection() as conn:
+            conn.executemany(_SQL_RECORD_ERROR, [
                 (site_id, error_type, error_message[:500])
-            )
+                for site_id, error_type, error_message in errors
+            ])
+
+
+class WriteQueue:
+    """Фоновая запись: копит INSERT/UPDATE и фиксирует их пачкой в одной транзакции"""
+
+    def __init__(self, db_manager, max_batch=100, max_delay=0.05):
+        self.db = db_manager
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self._queue = Queue()
+        Thread(target=self._run, daemon=True).start()
+
+    def put(self, sql, params=()):
+        self._queue.put((sql, params))
+
+    def flush(self):
+        """Ждет, пока все поставленные в очередь запросы будут записаны"""
+        self._queue.join()
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.max_delay
+            while len(batch) < self.max_batch:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=timeout))
+                except Empty:
+                    break
+
+            self._write_batch(batch)
+            for _ in batch:
+                self._queue.task_done()
+
+    def _write_batch(self, batch):
+        try:
+            with self.db.get_connection() as conn:
+                for sql, params in batch:
+                    try:
+                        conn.execute(sql, params)
+                    except sqlite3.Error as e:
+                        logger.error(f"Error in queued write: {e}")
+        except Exception as e:
+            logger.error(f"Error writing batch of {len(batch)} statements: {e}")
 
 
 # ==================== СИСТЕМА УМНЫХ УВЕДОМЛЕНИЙ ====================
 
+# Строки 'high'/'medium'/'low' нельзя сравнивать напрямую: лексикографически 'medium' > 'high'
+_IMPORTANCE_RANK = {'high': 2, 'medium': 1, 'low': 0}
+_IMPORTANCE_BASE_SCORE = {'high': 1.0, 'medium': 0.5, 'low': 0.2}
+# Минимальная итоговая оценка (важность * вес категории) для отправки уведомления
+_NOTIFICATION_THRESHOLD = 0.3
+_IMPORTANCE_EMOJI = {"high": "🔴", "medium": "🟡", "low": "🔵"}
+_CATEGORY_NAMES_RU = {
+    "content": "Контент", "design": "Дизайн",
+    "technical": "Техническое", "commerce": "Коммерция", "news": "Новости"
+}
+
+# Копируется через deepcopy перед использованием: вложенные словари изменяемы
+_DEFAULT_PREFERENCES = {
+    'preferred_categories': ['content', 'design', 'technical'],
+    'importance_weights': {'content': 1.0, 'design': 0.7, 'technical': 0.3},
+    'notification_frequency': 'immediate',
+    'learning_data': {
+        'positive_feedback': 0,
+        'negative_feedback': 0
+    }
+}
+
+# Шаблон разбирается один раз при импорте, а не собирается f-строкой на каждое изменение
+_IMPORTANCE_PROMPT = string.Template("""
+        Ты - умный фильтр уведомлений. Проанализируй изменения на сайте и определи их важность для конкретного пользователя.
+
+        ДАННЫЕ ПОЛЬЗОВАТЕЛЯ:
+        - Имя: $first_name
+        - Предпочтения: $preferred_categories
+        - Веса важности: $importance_weights
+        - Активность: $activity_level
+
+        ИНФОРМАЦИЯ О ИЗМЕНЕНИЯХ:
+        - Сайт: $site_name
+        - URL: $url
+        - Тип изменений: $change_type
+        - Дифф изменений: $diff
+
+        ПРОАНАЛИЗИРУЙ:
+        1. Категория изменений (content/design/technical/commerce/news)
+        2. Уровень важности (high/medium/low)
+        3. Насколько это важно для ЭТОГО пользователя
+        4. Ключевые аспекты изменений
+        5. Рекомендация по отправке уведомления
+        6. Текст уведомления для пользователя: учитывает его предпочтения, выделяет
+           самое важное для него, имеет персонализированный тон, краткий (2-3 предложения)
+           и включает призыв к действию
+
+        ФОРМАТ ОТВЕТА (JSON):
+        {
+            "category": "content/design/technical/commerce/news",
+            "importance": "high/medium/low",
+            "personal_importance_score": 0.85,
+            "key_aspects": ["аспект1", "аспект2", "аспект3"],
+            "should_notify": true/false,
+            "reasoning": "Обоснование решения",
+            "personalized_summary": "Краткое описание для пользователя",
+            "personalized_message": "Текст уведомления"
+        }
+        """)
+
+
 class UserPreferenceManager:
     def __init__(self, db_manager):
         self.db = db_manager
+        # Кэш настроек в памяти (write-through): запись в БД сразу обновляет кэш
+        self._prefs_cache = {}
+        self._prefs_lock = Lock()
+        # Изменения настроек одного пользователя (чтение - правка - запись в БД и
+        # кэш) идут из рабочих потоков и выполняются строго по очереди
+        self._user_locks = defaultdict(RLock)
 
-    def get_user_preferences(self, user_id):
-        with self.db.get_connection() as conn:
-            row = conn.execute(
-                'SELECT * FROM user_preferences WHERE user_id = ?', (user_id,)
-            ).fetchone()
+    def _user_lock(self, user_id):
+        with self._prefs_lock:
+            return self._user_locks[user_id]
 
-            if row:
-                return {
-                    'preferred_categories': row['preferred_categories'].split(','),
-                    'importance_weights': json.loads(row['importance_weights']),
-                    'notification_frequency': row['notification_frequency'],
-                    'learning_data': json.loads(row['learning_data'])
-                }
-            else:
-                default_prefs = {
-                    'preferred_categories': ['content', 'design', 'technical'],
-                    'importance_weights': {'content': 1.0, 'design': 0.7, 'technical': 0.3},
-                    'notification_frequency': 'immediate',
-                    'learning_data': {
-                        'positive_feedback': 0,
-                        'negative_feedback': 0,
-                        'learned_patterns': {}
-                    }
-                }
-                self.update_user_preferences(user_id, default_prefs)
-                return default_prefs
+    def get_user_preferences(self, user_id):
+        with self._prefs_lock:
+            cached = self._prefs_cache.get(user_id)
+        if cached is not None:
+            return copy.deepcopy(cached)
+
+        with self.db.get_read_connection() as conn:
+            row = conn.execute(_SQL_GET_PREFERENCES, (user_id,)).fetchone()
+
+        # Настройки по умолчанию не записываются в БД при чтении: строка
+        # появится при первом реальном изменении (например, отзыве)
+        prefs = self._row_to_preferences(row) if row else copy.deepcopy(_DEFAULT_PREFERENCES)
+        # Если за время чтения настройки уже обновили, в кэше остается более новая версия
+        with self._prefs_lock:
+            cached = self._prefs_cache.setdefault(user_id, prefs)
+        return copy.deepcopy(cached)
+
+    def get_many_user_preferences(self, user_ids):
+        """Настройки сразу для многих пользователей: один запрос вместо запроса на каждого"""
+        prefs_map = {}
+        missing = []
+        with self._prefs_lock:
+            for user_id in set(user_ids):
+                cached = self._prefs_cache.get(user_id)
+                if cached is not None:
+                    prefs_map[user_id] = copy.deepcopy(cached)
+                else:
+                    missing.append(user_id)
 
-    def update_user_preferences(self, user_id, preferences):
-        with self.db.get_connection() as conn:
-            conn.execute('''
-                INSERT OR REPLACE INTO user_preferences 
-                (user_id, preferred_categories, importance_weights, notification_frequency, learning_data, updated_at)
-                VALUES (?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
-            ''', (
-                user_id,
-                ','.join(preferences['preferred_categories']),
-                json.dumps(preferences['importance_weights']),
-                preferences['notification_frequency'],
-                json.dumps(preferences['learning_data'])
-            ))
+        if not missing:
+            return prefs_map
 
-    def record_feedback(self, user_id, notification_id, feedback_type, change_data):
-        with self.db.get_connection() as conn:
-            conn.execute('''
-                INSERT INTO user_feedback 
-                (user_id, notification_id, feedback_type, change_category, importance_level)
-                VALUES (?, ?, ?, ?, ?)
-            ''', (user_id, notification_id, feedback_type,
-                  change_data.get('category'), change_data.get('importance')))
+        placeholders = ','.join('?' * len(missing))
+        with self.db.get_read_connection() as conn:
+            rows = conn.execute(
+                f'SELECT * FROM user_preferences WHERE user_id IN ({placeholders})', missing
+            ).fetchall()
 
-            conn.execute('''
-                UPDATE notification_history 
-                SET feedback_received = TRUE 
-                WHERE notification_id = ? AND user_id = ?
-            ''', (notification_id, user_id))
+        loaded = {row['user_id']: self._row_to_preferences(row) for row in rows}
+        for user_id in missing:
+            prefs = loaded.get(user_id) or copy.deepcopy(_DEFAULT_PREFERENCES)
+            with self._prefs_lock:
+                cached = self._prefs_cache.setdefault(user_id, prefs)
+            prefs_map[user_id] = copy.deepcopy(cached)
 
-        self.update_learning_model(user_id, feedback_type, change_data)
+        return prefs_map
 
-    def update_learning_model(self, user_id, feedback_type, change_data):
-        prefs = self.get_user_preferences(user_id)
-        learning_data = prefs['learning_data']
+    def _row_to_preferences(self, row):
+        return {
+            'preferred_categories': row['preferred_categories'].split(','),
+            'importance_weights': {
+                'content': row['weight_content'],
+                'design': row['weight_design'],
+                'technical': row['weight_technical']
+            },
+            'notification_frequency': row['notification_frequency'],
+            'learning_data': {
+                'positive_feedback': row['positive_feedback'],
+                'negative_feedback': row['negative_feedback']
+            }
+        }
 
-        category = change_data.get('category')
-        importance = change_data.get('importance')
+    def update_user_preferences(self, user_id, preferences):
+        # БД и кэш обновляются под одной блокировкой пользователя, иначе в них
+        # могли бы оказаться результаты разных писателей
+        with self._user_lock(user_id):
+            with self.db.get_connection() as conn:
+                conn.execute(_SQL_UPSERT_PREFERENCES, (
+                    user_id,
+                    ','.join(preferences['preferred_categories']),
+                    preferences['notification_frequency'],
+                    preferences['importance_weights']['content'],
+                    preferences['importance_weights']['design'],
+                    preferences['importance_weights']['technical'],
+                    preferences['learning_data']['positive_feedback'],
+                    preferences['learning_data']['negative_feedback']
+                ))
+
+            with self._prefs_lock:
+                self._prefs_cache[user_id] = copy.deepcopy(preferences)
 
-        if feedback_type == 'like':
-            learning_data['positive_feedback'] += 1
-        elif feedback_type in ['dislike', 'dismiss']:
-            learning_data['negative_feedback'] += 1
+    def record_feedback(self, user_id, notification_id, feedback_type, change_data):
+        self.db.write_queue.put(_SQL_RECORD_FEEDBACK, (
+            user_id, notification_id, feedback_type,
+            change_data.get('category'), change_data.get('importance')
+        ))
+        self.db.write_queue.put(_SQL_MARK_FEEDBACK_RECEIVED, (notification_id, user_id))
 
-        key = f"{category}_{importance}"
-        if key not in learning_data['learned_patterns']:
-            learning_data['learned_patterns'][key] = {'likes': 0, 'dislikes': 0}
+        self.update_learning_model(user_id, feedback_type, change_data)
 
-        if feedback_type == 'like':
-            learning_data['learned_patterns'][key]['likes'] += 1
-        elif feedback_type in ['dislike', 'dismiss']:
-            learning_data['learned_patterns'][key]['dislikes'] += 1
+    def update_learning_model(self, user_id, feedback_type, change_data):
+        likes = 1 if feedback_type == 'like' else 0
+        dislikes = 1 if feedback_type in ['dislike', 'dismiss'] else 0
+
+        # Отзывы приходят параллельно: без блокировки одновременные
+        # чтение - правка - запись теряли бы счетчики и изменения весов
+        with self._user_lock(user_id):
+            prefs = self.get_user_preferences(user_id)
+            learning_data = prefs['learning_data']
+            learning_data['positive_feedback'] += likes
+            learning_data['negative_feedback'] += dislikes
+
+            # Счетчики паттерна увеличиваются прямо в SQLite, обратно читаются
+            # только паттерны, по которым уже хватает отзывов
+            with self.db.get_connection() as conn:
+                conn.execute(_SQL_RECORD_PATTERN, (
+                    user_id, str(change_data.get('category')), str(change_data.get('importance')),
+                    likes, dislikes
+                ))
+                patterns = conn.execute(_SQL_GET_TRAINED_PATTERNS, (user_id,)).fetchall()
 
-        self.adjust_importance_weights(user_id, learning_data)
-        prefs['learning_data'] = learning_data
-        self.update_user_preferences(user_id, prefs)
+            # Настройки загружаются один раз и сохраняются одной записью
+            self.adjust_importance_weights(prefs, patterns)
+            self.update_user_preferences(user_id, prefs)
 
-    def adjust_importance_weights(self, user_id, learning_data):
-        prefs = self.get_user_preferences(user_id)
+    def adjust_importance_weights(self, prefs, patterns):
         weights = prefs['importance_weights']
 
-        for pattern_key, feedback in learning_data['learned_patterns'].items():
-            category = pattern_key.split('_')[0]
-            total_feedback = feedback['likes'] + feedback['dislikes']
-
-            if total_feedback >= 3:
-                like_ratio = feedback['likes'] / total_feedback
+        for pattern in patterns:
+            category = pattern['category']
+            if category not in weights:
+                continue
 
-                if like_ratio > 0.7:
-                    weights[category] = min(1.0, weights[category] + 0.1)
-                elif like_ratio < 0.3:
-                    weights[category] = max(0.1, weights[category] - 0.1)
+            like_ratio = pattern['likes'] / (pattern['likes'] + pattern['dislikes'])
 
-        prefs['importance_weights'] = weights
-        self.update_user_preferences(user_id, prefs)
+            if like_ratio > 0.7:
+                weights[category] = min(1.0, weights[category] + 0.1)
+            elif like_ratio < 0.3:
+                weights[category] = max(0.1, weights[category] - 0.1)
 
-    def should_send_notification(self, user_id, change_analysis):
-        prefs = self.get_user_preferences(user_id)
+    def should_send_notification(self, user_id, change_analysis, prefs=None):
+        if prefs is None:
+            prefs = self.get_user_preferences(user_id)
 
         category = change_analysis.get('category')
         if category not in prefs['preferred_categories']:
             return False
 
         importance = change_analysis.get('importance', 'medium')
-        base_importance_score = {'high': 1.0, 'medium': 0.5, 'low': 0.2}[importance]
+        base_importance_score = _IMPORTANCE_BASE_SCORE.get(importance, _IMPORTANCE_BASE_SCORE['medium'])
         user_weight = prefs['importance_weights'].get(category, 0.5)
 
         final_score = base_importance_score * user_weight
-        threshold = 0.3
 
-        return final_score >= threshold
+        return final_score >= _NOTIFICATION_THRESHOLD
+
+    def can_pass_filter(self, prefs):
+        """Может ли хоть какая-то оценка изменения пройти фильтр пользователя"""
+        return any(
+            _IMPORTANCE_BASE_SCORE['high'] * prefs['importance_weights'].get(category, 0.5)
+            >= _NOTIFICATION_THRESHOLD
+            for category in prefs['preferred_categories']
+        )
 
 
 class AINotificationFilter:
     def __init__(self, api_key=None):
         self.api_url = "https://api.aitunnel.ru/v1/chat/completions"
         self.api_key = api_key
+        # Один асинхронный клиент на все вызовы API: соединение с хостом
+        # переиспользуется, а запросы не блокируют цикл событий бота
+        self.client = httpx.AsyncClient(
+            headers={"Authorization": f"Bearer {api_key}"},
+            timeout=30,
+            transport=httpx.AsyncHTTPTransport(
+                retries=2,
+                limits=httpx.Limits(max_connections=16, max_keepalive_connections=16)
+            )
+        )
 
-    def analyze_change_importance(self, change_data, user_context=None):
+    async def analyze_change_importance(self, change_data, user_context=None):
         if not self.api_key:
             return self._basic_analysis(change_data, user_context)
 
         try:
             prompt = self._create_importance_prompt(change_data, user_context)
 
-            headers = {
-                "Authorization": f"Bearer {self.api_key}",
-                "Content-Type": "application/json"
-            }
-
             data = {
                 "model": "gpt-3.5-turbo",
                 "messages": [{"role": "user", "content": prompt}],
                 "temperature": 0.2,
-                "max_tokens": 600
+                "max_tokens": 900
             }
 
-            response = requests.post(self.api_url, headers=headers, json=data, timeout=30)
+            response = await self.client.post(self.api_url, json=data)
             response.raise_for_status()
 
             result = response.json()
@@ -412,38 +815,20 @@ class AINotificationFilter:
     def _create_importance_prompt(self, change_data, user_context):
         user_info = user_context or {}
 
-        return f"""
-        Ты - умный фильтр уведомлений. Проанализируй изменения на сайте и определи их важность для конкретного пользователя.
-
-        ДАННЫЕ ПОЛЬЗОВАТЕЛЯ:
-        - Имя: {user_info.get('first_name', 'Пользователь')}
-        - Предпочтения: {user_info.get('preferred_categories', ['content', 'design', 'technical'])}
-        - Активность: {user_info.get('activity_level', 'средняя')}
-
-        ИНФОРМАЦИЯ О ИЗМЕНЕНИЯХ:
-        - Сайт: {change_data['site_name']}
-        - URL: {change_data['url']}
-        - Тип изменений: {change_data.get('change_type', 'неизвестно')}
-        - Дифф изменений: {change_data['diff'][:1000]}
-
-        ПРОАНАЛИЗИРУЙ:
-        1. Категория изменений (content/design/technical/commerce/news)
-        2. Уровень важности (high/medium/low)
-        3. Насколько это важно для ЭТОГО пользователя
-        4. Ключевые аспекты изменений
-        5. Рекомендация по отправке уведомления
+        return _IMPORTANCE_PROMPT.substitute(
+            first_name=user_info.get('first_name', 'Пользователь'),
+            preferred_categories=user_info.get('preferred_categories', ['content', 'design', 'technical']),
+            importance_weights=user_info.get('importance_weights', {}),
+            activity_level=user_info.get('activity_level', 'средняя'),
+            site_name=change_data['site_name'],
+            url=change_data['url'],
+            change_type=change_data.get('change_type', 'неизвестно'),
+            diff=change_data['diff'][:1000]
+        )
 
-        ФОРМАТ ОТВЕТА (JSON):
-        {{
-            "category": "content/design/technical/commerce/news",
-            "importance": "high/medium/low",
-            "personal_importance_score": 0.85,
-            "key_aspects": ["аспект1", "аспект2", "аспект3"],
-            "should_notify": true/false,
-            "reasoning": "Обоснование решения",
-            "personalized_summary": "Краткое описание для пользователя"
-        }}
-        """
+    def cheap_precheck(self, change_data, user_context=None):
+        """Оценка без обращения к API - по размеру изменений"""
+        return self._basic_analysis(change_data, user_context)
 
     def _basic_analysis(self, change_data, user_context):
         change_size = len(change_data['diff'])
@@ -469,71 +854,27 @@ class AINotificationFilter:
         }
 
     def generate_personalized_message(self, change_analysis, user_preferences):
-        if not self.api_key:
-            return self._basic_message(change_analysis, user_preferences)
-
-        try:
-            prompt = self._create_message_prompt(change_analysis, user_preferences)
-
-            headers = {
-                "Authorization": f"Bearer {self.api_key}",
-                "Content-Type": "application/json"
-            }
-
-            data = {
-                "model": "gpt-3.5-turbo",
-                "messages": [{"role": "user", "content": prompt}],
-                "temperature": 0.7,
-                "max_tokens": 500
-            }
-
-            response = requests.post(self.api_url, headers=headers, json=data, timeout=30)
-            response.raise_for_status()
-
-            result = response.json()
-            return result['choices'][0]['message']['content']
-
-        except Exception as e:
-            logger.error(f"Message generation error: {e}")
-            return self._basic_message(change_analysis, user_preferences)
-
-    def _create_message_prompt(self, change_analysis, user_preferences):
-        return f"""
-        Создай персонализированное уведомление об изменениях на сайте.
-
-        АНАЛИЗ ИЗМЕНЕНИЙ:
-        - Категория: {change_analysis['category']}
-        - Важность: {change_analysis['importance']}
-        - Ключевые аспекты: {', '.join(change_analysis['key_aspects'])}
-        - Сайт: {change_analysis.get('site_name', 'неизвестно')}
-
-        ПРЕДПОЧТЕНИЯ ПОЛЬЗОВАТЕЛЯ:
-        - Любимые категории: {user_preferences.get('preferred_categories', [])}
-        - Веса важности: {user_preferences.get('importance_weights', {})}
-
-        СОЗДАЙ УВЕДОМЛЕНИЕ КОТОРОЕ:
-        1. Учитывает предпочтения пользователя
-        2. Выделяет самое важное для него
-        3. Имеет персонализированный тон
-        4. Краткое и информативное (2-3 предложения)
-        5. Включает призыв к действию
-
-        Ответь только текстом уведомления без дополнительных пояснений.
-        """
+        # Текст уведомления приходит вместе с анализом в одном ответе API
+        message = change_analysis.get('personalized_message')
+        return message or self._basic_message(change_analysis, user_preferences)
 
     def _basic_message(self, change_analysis, user_preferences):
         return f"Обнаружены изменения на сайте. Категория: {change_analysis['category']}, Важность: {change_analysis['importance']}"
 
 
 class NotificationGrouper:
-    def __init__(self):
-        self.pending_notifications = defaultdict(list)
+    def __init__(self, max_pending=64):
+        # Очередь на пользователя ограничена: при недоставке старые уведомления вытесняются
+        self.pending_notifications = defaultdict(lambda: deque(maxlen=max_pending))
+        self.lock = Lock()
 
     def add_notification(self, user_id, notification):
-        self.pending_notifications[user_id].append(notification)
+        with self.lock:
+            self.pending_notifications[user_id].append(notification)
 
     def get_grouped_notifications(self, user_id, time_window_minutes=30):
-        notifications = self.pending_notifications.get(user_id, [])
+        with self.lock:
+            notifications = list(self.pending_notifications.pop(user_id, ()))
 
         if not notifications:
             return []
@@ -552,7 +893,6 @@ class NotificationGrouper:
                     self._create_summary_notification(group)
                 )
 
-        self.pending_notifications[user_id] = []
         return summary_notifications
 
     def _create_summary_notification(self, notifications):
@@ -561,7 +901,9 @@ class NotificationGrouper:
         return {
             'site_name': main_notification['site_name'],
             'category': main_notification['category'],
-            'importance': max(n['importance'] for n in notifications),
+            'importance': max(
+                notifications, key=lambda n: _IMPORTANCE_RANK.get(n['importance'], 0)
+            )['importance'],
             'title': f"🔔 {len(notifications)} обновлений на {main_notification['site_name']}",
             'message': f"За последнее время произошло {len(notifications)} изменений в категории {main_notification['category']}.",
             'is_summary': True,
@@ -585,22 +927,33 @@ class SmartNotificationSystem:
             'user_feedback': {'likes': 0, 'dislikes': 0}
         }
 
-    async def process_change(self, user_id, site_info, change_data):
+    async def process_change(self, user_id, site_info, change_data, user_prefs=None):
         try:
-            user_prefs = self.preference_manager.get_user_preferences(user_id)
+            if user_prefs is None:
+                user_prefs = self.preference_manager.get_user_preferences(user_id)
             user_context = {
                 'first_name': 'Пользователь',
                 'preferred_categories': user_prefs['preferred_categories'],
+                'importance_weights': user_prefs['importance_weights'],
                 'activity_level': 'средняя'
             }
 
-            change_analysis = self.ai_filter.analyze_change_importance(
-                {**site_info, **change_data}, user_context
-            )
+            change = {**site_info, **change_data}
 
-            should_send = self.preference_manager.should_send_notification(
-                user_id, change_analysis
-            )
+            # К ИИ не обращаемся, только если никакой его ответ не прошел бы фильтр
+            # пользователя; оценка по размеру диффа - лишь запасной путь без ключа API
+            if not self.preference_manager.can_pass_filter(user_prefs):
+                should_send = False
+            else:
+                if self.ai_filter.api_key:
+                    change_analysis = await self.ai_filter.analyze_change_importance(
+                        change, user_context
+                    )
+                else:
+                    change_analysis = self.ai_filter.cheap_precheck(change, user_context)
+                should_send = self.preference_manager.should_send_notification(
+                    user_id, change_analysis, user_prefs
+                )
 
             if not should_send:
                 self.stats['notifications_filtered'] += 1
@@ -664,12 +1017,8 @@ class SmartNotificationSystem:
             logger.error(f"Error sending notification: {e}")
 
     def _get_notification_title(self, analysis):
-        emoji = {"high": "🔴", "medium": "🟡", "low": "🔵"}.get(analysis['importance'], "⚪")
-        category_names = {
-            "content": "Контент", "design": "Дизайн",
-            "technical": "Техническое", "commerce": "Коммерция", "news": "Новости"
-        }
-        return f"{emoji} Обновление {category_names.get(analysis['category'], '')}"
+        emoji = _IMPORTANCE_EMOJI.get(analysis['importance'], "⚪")
+        return f"{emoji} Обновление {_CATEGORY_NAMES_RU.get(analysis['category'], '')}"
 
     def _format_notification_message(self, notification):
         if notification.get('is_summary'):
@@ -684,35 +1033,20 @@ class SmartNotificationSystem:
         return message
 
     def _save_notification_history(self, user_id, notification):
-        try:
-            with self.db.get_connection() as conn:
-                conn.execute('''
-                    INSERT INTO notification_history 
-                    (user_id, notification_id, site_name, change_category, importance_level)
-                    VALUES (?, ?, ?, ?, ?)
-                ''', (user_id, notification['notification_id'], notification['site_name'],
-                      notification['category'], notification['importance']))
-        except Exception as e:
-            logger.error(f"Error saving notification history: {e}")
+        # Запись уходит в фоновую очередь и фиксируется пачкой вместе с соседними
+        self.db.write_queue.put(_SQL_SAVE_NOTIFICATION, (
+            user_id, notification['notification_id'], notification['site_name'],
+            notification['category'], notification['importance']
+        ))
 
     async def handle_feedback(self, user_id, notification_id, feedback_type):
         try:
-            with self.db.get_connection() as conn:
-                notification = conn.execute('''
-                    SELECT * FROM notification_history 
-                    WHERE notification_id = ? AND user_id = ?
-                ''', (notification_id, user_id)).fetchone()
-
-            if notification:
-                change_data = {
-                    'category': notification['change_category'],
-                    'importance': notification['importance_level']
-                }
-
-                self.preference_manager.record_feedback(
-                    user_id, notification_id, feedback_type, change_data
-                )
+            # Работа с SQLite выполняется в пуле потоков, чтобы не блокировать цикл событий
+            recorded = await asyncio.to_thread(
+                self._record_feedback_sync, user_id, notification_id, feedback_type
+            )
 
+            if recorded:
                 if feedback_type == 'like':
                     self.stats['user_feedback']['likes'] += 1
                 elif feedback_type in ['dislike', 'dismiss']:
@@ -722,16 +1056,87 @@ class SmartNotificationSystem:
         except Exception as e:
             logger.error(f"Error handling feedback: {e}")
 
+    def _record_feedback_sync(self, user_id, notification_id, feedback_type):
+        with self.db.get_read_connection() as conn:
+            notification = conn.execute(
+                _SQL_GET_NOTIFICATION, (notification_id, user_id)
+            ).fetchone()
+
+        if not notification:
+            return False
+
+        change_data = {
+            'category': notification['change_category'],
+            'importance': notification['importance_level']
+        }
+        self.preference_manager.record_feedback(
+            user_id, notification_id, feedback_type, change_data
+        )
+        return True
+
 
 # ==================== TELEGRAM BOT ====================
 
+# Неизменяемые тексты ответов собираются один раз при импорте
+_WELCOME_TMPL = """
+👋 Привет, {first_name}!
+
+Я - умный бот для мониторинга сайтов с ИИ-анализом.
+
+📋 *Доступные команды:*
+/subscribe - Подписаться на уведомления
+/unsubscribe - Отписаться от уведомлений  
+/status - Статус мониторинга
+/monitor [url] - Начать мониторинг сайта
+/mysites - Мои сайты для мониторинга
+/delete - Удалить сайт из мониторинга
+/recommend - Персональные рекомендации
+
+🚀 Начни с команды /monitor чтобы добавить первый сайт!
+        """
+
+_STATUS_TMPL = """
+📊 *Статус мониторинга*
+
+👤 *Пользователь:* {first_name}
+🔔 *Подписка:* {subscription}
+🌐 *Ваших сайтов:* {user_site_count}
+📈 *Всего сайтов в системе:* {total_site_count}
+🔄 *Система мониторинга:* {monitoring}
+
+💡 Используйте /monitor чтобы добавить сайты
+💡 Используйте /delete чтобы удалить сайты
+        """
+
+_NO_SITES_TEXT = (
+    "📭 У вас нет сайтов в мониторинге.\n"
+    "Добавьте сайты командой /monitor [url]"
+)
+
+_RECOMMENDATIONS = (
+    "💡 *Совет 1:* Мониторьте сайты в разное время суток",
+    "💡 *Совет 2:* Добавляйте CSS-селекторы для точного мониторинга",
+    "💡 *Совет 3:* Используйте лайки/дизлайки чтобы обучить ИИ",
+    "💡 *Совет 4:* Начинайте с 2-3 сайтов, затем добавляйте больше",
+    "💡 *Совет 5:* Проверяйте статус мониторинга командой /status"
+)
+
+
 class MonitoringBot:
-    def __init__(self, token, ai_api_key=None):
-        self.application = Application.builder().token(token).build()
+    def __init__(self, token, ai_api_key=None, check_interval_minutes=10):
+        self.application = (
+            Application.builder()
+            .token(token)
+            .post_shutdown(self._shutdown)
+            .build()
+        )
         self.db = DatabaseManager()
         self.notification_system = SmartNotificationSystem(
             self.application.bot, self.db, ai_api_key
         )
+        # Мониторинг работает в JobQueue бота, на том же цикле событий и с той же БД
+        self.monitoring_system = SmartMonitoringSystem(self.db, self.notification_system)
+        self.monitoring_system.start_monitoring(self.application.job_queue, check_interval_minutes)
         self.monitoring_active = True
 
         self.setup_handlers()
@@ -749,30 +1154,15 @@ class MonitoringBot:
 
     async def start_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         user = update.effective_user
-        self.db.create_user(user.id, user.username, user.first_name)
-
-        welcome_text = f"""
-👋 Привет, {user.first_name}!
-
-Я - умный бот для мониторинга сайтов с ИИ-анализом.
-
-📋 *Доступные команды:*
-/subscribe - Подписаться на уведомления
-/unsubscribe - Отписаться от уведомлений  
-/status - Статус мониторинга
-/monitor [url] - Начать мониторинг сайта
-/mysites - Мои сайты для мониторинга
-/delete - Удалить сайт из мониторинга
-/recommend - Персональные рекомендации
-
-🚀 Начни с команды /monitor чтобы добавить первый сайт!
-        """
+        await asyncio.to_thread(self.db.create_user, user.id, user.username, user.first_name)
 
-        await update.message.reply_text(welcome_text, parse_mode='Markdown')
+        await update.message.reply_text(
+            _WELCOME_TMPL.format(first_name=user.first_name), parse_mode='Markdown'
+        )
 
     async def subscribe_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         user = update.effective_user
-        self.db.subscribe_user(user.id)
+        await asyncio.to_thread(self.db.subscribe_user, user.id)
 
         await update.message.reply_text(
             "✅ Вы успешно подписались на уведомления!\n"
@@ -782,7 +1172,7 @@ class MonitoringBot:
 
     async def unsubscribe_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         user = update.effective_user
-        self.db.unsubscribe_user(user.id)
+        await asyncio.to_thread(self.db.unsubscribe_user, user.id)
 
         await update.message.reply_text(
             "🔕 Вы отписались от уведомлений.\n"
@@ -792,22 +1182,15 @@ class MonitoringBot:
 
     async def status_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         user = update.effective_user
-        user_data = self.db.get_user(user.id)
-        user_sites = self.db.get_user_sites(user.id)
-        all_sites = self.db.get_all_monitored_sites()
-
-        status_text = f"""
-📊 *Статус мониторинга*
-
-👤 *Пользователь:* {user.first_name}
-🔔 *Подписка:* {'✅ Активна' if user_data and user_data['subscribed'] else '❌ Неактивна'}
-🌐 *Ваших сайтов:* {len(user_sites)}
-📈 *Всего сайтов в системе:* {len(all_sites)}
-🔄 *Система мониторинга:* {'✅ Активна' if self.monitoring_active else '⏸️ Остановлена'}
-
-💡 Используйте /monitor чтобы добавить сайты
-💡 Используйте /delete чтобы удалить сайты
-        """
+        subscribed, user_site_count, total_site_count = await asyncio.to_thread(self.db.get_status_counts, user.id)
+
+        status_text = _STATUS_TMPL.format(
+            first_name=user.first_name,
+            subscription='✅ Активна' if subscribed else '❌ Неактивна',
+            user_site_count=user_site_count,
+            total_site_count=total_site_count,
+            monitoring='✅ Активна' if self.monitoring_active else '⏸️ Остановлена'
+        )
 
         await update.message.reply_text(status_text, parse_mode='Markdown')
 
@@ -834,7 +1217,7 @@ class MonitoringBot:
             domain = parsed_url.netloc
             site_name = domain.replace('www.', '')
 
-            success = self.db.add_monitored_site(user.id, url, site_name)
+            success = await asyncio.to_thread(self.db.add_monitored_site, user.id, url, site_name)
 
             if success:
                 await update.message.reply_text(
@@ -857,13 +1240,10 @@ class MonitoringBot:
 
     async def mysites_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         user = update.effective_user
-        user_sites = self.db.get_user_sites(user.id)
+        user_sites = await asyncio.to_thread(self.db.get_user_sites, user.id)
 
         if not user_sites:
-            await update.message.reply_text(
-                "📭 У вас нет сайтов в мониторинге.\n"
-                "Добавьте сайты командой /monitor [url]"
-            )
+            await update.message.reply_text(_NO_SITES_TEXT)
             return
 
         sites_text = "🌐 *Ваши сайты в мониторинге:*\n\n"
@@ -875,13 +1255,10 @@ class MonitoringBot:
 
     async def delete_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         user = update.effective_user
-        user_sites = self.db.get_user_sites(user.id)
+        user_sites = await asyncio.to_thread(self.db.get_user_sites, user.id)
 
         if not user_sites:
-            await update.message.reply_text(
-                "📭 У вас нет сайтов в мониторинге.\n"
-                "Добавьте сайты командой /monitor [url]"
-            )
+            await update.message.reply_text(_NO_SITES_TEXT)
             return
 
         keyboard = []
@@ -902,7 +1279,7 @@ class MonitoringBot:
 
     async def recommend_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         user = update.effective_user
-        user_sites = self.db.get_user_sites(user.id)
+        user_sites = await asyncio.to_thread(self.db.get_user_sites, user.id)
 
         if not user_sites:
             await update.message.reply_text(
@@ -910,16 +1287,8 @@ class MonitoringBot:
             )
             return
 
-        recommendations = [
-            "💡 *Совет 1:* Мониторьте сайты в разное время суток",
-            "💡 *Совет 2:* Добавляйте CSS-селекторы для точного мониторинга",
-            "💡 *Совет 3:* Используйте лайки/дизлайки чтобы обучить ИИ",
-            "💡 *Совет 4:* Начинайте с 2-3 сайтов, затем добавляйте больше",
-            "💡 *Совет 5:* Проверяйте статус мониторинга командой /status"
-        ]
-
         await update.message.reply_text(
-            f"🎯 *Персональные рекомендации:*\n\n{random.choice(recommendations)}",
+            f"🎯 *Персональные рекомендации:*\n\n{random.choice(_RECOMMENDATIONS)}",
             parse_mode='Markdown'
         )
 
@@ -930,33 +1299,127 @@ class MonitoringBot:
         user_id = query.from_user.id
         data = query.data
 
+        # Нажатие уже подтверждено; работа с БД идет фоновой задачей, и обработчик
+        # не задерживает следующие обновления
         if data.startswith('delete_'):
             site_id = int(data.split('_')[1])
-            if self.db.delete_site(user_id, site_id):
-                await query.edit_message_text("✅ Сайт удален из мониторинга!")
-            else:
-                await query.edit_message_text("❌ Не удалось удалить сайт")
+            context.application.create_task(
+                self._delete_site(query, user_id, site_id), update=update
+            )
 
         elif data.startswith(('like_', 'dislike_', 'dismiss_')):
             feedback_type, notification_id = data.split('_', 1)
-            await self.notification_system.handle_feedback(
-                user_id, notification_id, feedback_type
+            context.application.create_task(
+                self.notification_system.handle_feedback(user_id, notification_id, feedback_type),
+                update=update
             )
 
+    async def _delete_site(self, query, user_id, site_id):
+        if await asyncio.to_thread(self.db.delete_site, user_id, site_id):
+            await query.edit_message_text("✅ Сайт удален из мониторинга!")
+        else:
+            await query.edit_message_text("❌ Не удалось удалить сайт")
+
     def run(self):
         """Запуск бота"""
         print("🤖 Запуск Telegram бота...")
         self.application.run_polling()
 
+    async def _shutdown(self, application):
+        """Освобождает ресурсы после остановки приложения"""
+        # JobQueue к этому моменту уже остановлен приложением, задачу снимать не нужно
+        self.monitoring_system.active = False
+        await asyncio.to_thread(self.monitoring_system.close)
+        await self.notification_system.ai_filter.client.aclose()
+        await asyncio.to_thread(self.db.close)
+
 
 # ==================== СИСТЕМА МОНИТОРИНГА ====================
 
+# Сколько сайтов проверяется одновременно за один проход
+_MAX_CONCURRENT_CHECKS = 20
+# Минимальный интервал между запросами к одному хосту, секунды
+_HOST_DELAY = 2.0
+# Размер блока при потоковом чтении ответа
+_FETCH_CHUNK_SIZE = 65536
+# Строк контекста вокруг изменений в диффе
+_DIFF_CONTEXT = 2
+# Предельная длина диффа, передаваемого в уведомление
+_MAX_DIFF_CHARS = 5000
+# Пробельные символы внутри строки и переводы строк вместе с окружающими
+# пробелами и пустыми строками: текст страницы сохраняет разбивку на строки
+_INLINE_WS_RE = re.compile(r'[^\S\n]+')
+_LINE_BREAK_RE = re.compile(r' ?\n\s*')
+# Теги, содержимое которых не относится к видимому тексту страницы
+_UNWANTED_TAGS = frozenset({'script', 'style', 'meta', 'link', 'noscript', 'iframe'})
+
+_USER_AGENTS = (
+    'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
+    'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/119.0.0.0 Safari/537.36',
+    'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
+    'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36'
+)
+
+_BASE_HEADERS = {
+    'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8',
+    'Accept-Language': 'ru-RU,ru;q=0.9,en-US;q=0.8,en;q=0.7',
+    'Accept-Encoding': 'gzip, deflate',
+    'Connection': 'keep-alive',
+    'Upgrade-Insecure-Requests': '1',
+    'DNT': '1',
+    'Cache-Control': 'max-age=0'
+}
+
+
+def _changed_window(old_lines, new_lines, context=_DIFF_CONTEXT):
+    """Отрезает совпадающие начало и конец, оставляя context строк вокруг изменений"""
+    limit = min(len(old_lines), len(new_lines))
+    lo = 0
+    while lo < limit and old_lines[lo] == new_lines[lo]:
+        lo += 1
+    hi = 0
+    while hi < limit - lo and old_lines[-1 - hi] == new_lines[-1 - hi]:
+        hi += 1
+
+    lo = max(lo - context, 0)
+    hi = max(hi - context, 0)
+    return old_lines[lo:len(old_lines) - hi], new_lines[lo:len(new_lines) - hi]
+
+
+class _UnverifiedTLSAdapter(HTTPAdapter):
+    """HTTPAdapter с общим SSL-контекстом без проверки сертификата и имени хоста.
+
+    Без него urllib3 собирает новый SSL-контекст для каждого соединения.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self._ssl_context = ssl.create_default_context()
+        self._ssl_context.check_hostname = False
+        self._ssl_context.verify_mode = ssl.CERT_NONE
+        super().__init__(*args, **kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs['ssl_context'] = self._ssl_context
+        return super().init_poolmanager(*args, **kwargs)
+
+
 class SmartMonitoringSystem:
     def __init__(self, db_manager, notification_system):
         self.db = db_manager
         self.notification_system = notification_system
         self.active = True
+        self._job = None
+        # Время цикла событий, раньше которого хост нельзя запрашивать снова
+        self._host_next_ok = defaultdict(float)
+        # Ошибки проверок за текущий проход (site_id, тип, сообщение)
+        self._error_buf = []
         self.session = self._create_session()
+        # Отдельный пул для скачивания страниц: запрос может блокироваться
+        # на десятки секунд, и в общем пуле asyncio.to_thread за ним вставали бы
+        # обращения обработчиков бота к БД
+        self._fetch_executor = ThreadPoolExecutor(
+            max_workers=_MAX_CONCURRENT_CHECKS, thread_name_prefix='fetch'
+        )
 
     def _create_session(self):
         """Создает сессию requests с повторными попытками"""
@@ -969,186 +1432,277 @@ class SmartMonitoringSystem:
             allowed_methods=["HEAD", "GET", "OPTIONS"]
         )
 
-        adapter = HTTPAdapter(max_retries=retry_strategy, pool_connections=100, pool_maxsize=100)
+        adapter = _UnverifiedTLSAdapter(max_retries=retry_strategy, pool_connections=100, pool_maxsize=100)
         session.mount("http://", adapter)
         session.mount("https://", adapter)
 
         return session
 
-    def start_monitoring(self, interval_minutes=10):
-        self.active = True
-        logger.info(f"🚀 Запуск системы мониторинга (интервал: {interval_minutes} минут)")
+    def _fetch_body(self, url, headers):
+        """Читает ответ блоками, попутно считая хэш тела.
 
-        def monitoring_loop():
-            while self.active:
-                try:
-                    schedule.run_pending()
-                    time.sleep(1)
-                except Exception as e:
-                    logger.error(f"Error in monitoring loop: {e}")
+        Возвращает (блоки, кодировка из заголовков или None, хэш тела, ETag,
+        Last-Modified) или None, если сервер ответил 304 Not Modified.
+        """
+        # verify=False передается в запрос: session.verify перекрывается
+        # переменной окружения REQUESTS_CA_BUNDLE
+        with self.session.get(url, headers=headers, timeout=30, verify=False, stream=True) as response:
+            if response.status_code == 304:
+                return None
+            response.raise_for_status()
+            hasher = xxhash.xxh3_64()
+            chunks = []
+            for chunk in response.iter_content(_FETCH_CHUNK_SIZE):
+                hasher.update(chunk)
+                chunks.append(chunk)
+            # Без charset в заголовке кодировку определит парсер по <meta>
+            encoding = response.encoding if 'charset' in response.headers.get('Content-Type', '') else None
+        return (
+            chunks, encoding, hasher.digest(),
+            response.headers.get('ETag'), response.headers.get('Last-Modified')
+        )
 
-        Thread(target=monitoring_loop, daemon=True).start()
+    def start_monitoring(self, job_queue, interval_minutes=10):
+        """Ставит периодическую проверку в JobQueue бота: первый проход сразу после запуска"""
+        self.active = True
+        logger.info(f"🚀 Запуск системы мониторинга (интервал: {interval_minutes} минут)")
 
-        Thread(target=self.check_all_sites, daemon=True).start()
+        self._job = job_queue.run_repeating(
+            self.check_all_sites_async,
+            interval=interval_minutes * 60,
+            first=1,
+            name='check_all_sites'
+        )
 
-        schedule.every(interval_minutes).minutes.do(self.check_all_sites)
+    def close(self):
+        """Дожидается начатых скачиваний и закрывает пул потоков и HTTP-сессию"""
+        self._fetch_executor.shutdown(wait=True)
+        self.session.close()
 
     def stop_monitoring(self):
         self.active = False
-        schedule.clear()
+        if self._job is not None:
+            self._job.schedule_removal()
+            self._job = None
         logger.info("🛑 Мониторинг остановлен")
 
-    def check_all_sites(self):
+    async def check_all_sites_async(self, context=None):
+        """Проверяет сайты параллельно, не более _MAX_CONCURRENT_CHECKS одновременно"""
         if not self.active:
             return
 
         logger.info(f"🔍 Проверка сайтов... {datetime.now().strftime('%H:%M:%S')}")
 
         try:
-            sites = self.db.get_all_monitored_sites()
+            sites = await asyncio.to_thread(self.db.get_all_monitored_sites)
             logger.info(f"Найдено {len(sites)} сайтов для проверки")
 
-            for site in sites:
+            # Настройки всех владельцев сайтов загружаются одним запросом на проход
+            prefs_map = await asyncio.to_thread(
+                self.notification_system.preference_manager.get_many_user_preferences,
+                [site['user_id'] for site in sites]
+            )
+        except Exception as e:
+            logger.error(f"Error in check_all_sites: {e}")
+            return
+
+        # Один адрес у нескольких пользователей скачивается один раз за проход
+        url_to_sites = defaultdict(list)
+        for site in sites:
+            url_to_sites[site['url']].append(site)
+
+        semaphore = asyncio.Semaphore(_MAX_CONCURRENT_CHECKS)
+
+        async def guarded(url, url_sites):
+            async with semaphore:
+                # Слот хоста берется уже внутри семафора: иначе проверки, дождавшиеся
+                # своего времени в очереди к семафору, ушли бы к хосту подряд
+                await self._wait_for_host(url_sites[0]['domain'])
                 try:
-                    self.check_site(site)
-                    time.sleep(random.uniform(2, 5))
+                    changes = await asyncio.get_running_loop().run_in_executor(
+                        self._fetch_executor, self.check_url, url_sites
+                    )
                 except Exception as e:
-                    logger.error(f"Error checking site {site['url']}: {e}")
-                    continue
+                    logger.error(f"Error checking site {url}: {e}")
+                    return
 
-        except Exception as e:
-            logger.error(f"Error in check_all_sites: {e}")
+            # Уведомления отправляются здесь, в цикле событий бота, а не из рабочего потока
+            for site, changes_data in changes:
+                site_info = {
+                    'site_name': site['site_name'],
+                    'url': site['url']
+                }
+                try:
+                    await self.notification_system.process_change(
+                        site['user_id'], site_info, changes_data, prefs_map.get(site['user_id'])
+                    )
+                except Exception as e:
+                    logger.error(f"Error processing change for {site['url']}: {e}")
+
+        await asyncio.gather(*(guarded(url, url_sites) for url, url_sites in url_to_sites.items()))
 
-    def check_site(self, site):
+        errors, self._error_buf = self._error_buf, []
         try:
-            logger.info(f"Проверка сайта: {site['site_name']} ({site['url']})")
+            await asyncio.to_thread(self.db.record_errors_bulk, errors)
+        except Exception as e:
+            logger.error(f"Error saving check errors: {e}")
 
-            user_agents = [
-                'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
-                'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/119.0.0.0 Safari/537.36',
-                'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
-                'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36'
-            ]
+    async def _wait_for_host(self, host):
+        """Выдерживает _HOST_DELAY между запросами к одному хосту, не задерживая остальные"""
+        now = asyncio.get_running_loop().time()
+        slot = max(now, self._host_next_ok[host])
+        # Слот занимается до ожидания, чтобы параллельные проверки хоста встали в очередь
+        self._host_next_ok[host] = slot + _HOST_DELAY
+        if slot > now:
+            await asyncio.sleep(slot - now)
 
-            headers = {
-                'User-Agent': random.choice(user_agents),
-                'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8',
-                'Accept-Language': 'ru-RU,ru;q=0.9,en-US;q=0.8,en;q=0.7',
-                'Accept-Encoding': 'gzip, deflate',
-                'Connection': 'keep-alive',
-                'Upgrade-Insecure-Requests': '1',
-                'DNT': '1',
-                'Cache-Control': 'max-age=0'
-            }
+    def check_url(self, sites):
+        """Скачивает адрес один раз и сверяет страницу с каждой подпиской на него.
 
-            time.sleep(random.uniform(1, 3))
+        Возвращает список пар (сайт, данные об изменении) для изменившихся подписок.
+        """
+        url = sites[0]['url']
+        changes = []
+        try:
+            logger.info(f"Проверка сайта: {sites[0]['site_name']} ({url}, подписок: {len(sites)})")
+
+            # User-Agent закреплен за хостом: keep-alive соединения из пула
+            # переиспользуются, а не открываются заново под другой UA
+            host = sites[0]['domain']
+            user_agent = _USER_AGENTS[zlib.crc32(host.encode()) % len(_USER_AGENTS)]
+            headers = {**_BASE_HEADERS, 'User-Agent': user_agent}
+
+            # Условный запрос возможен, только если все подписки видели одну версию страницы
+            validators = {(site['etag'], site['last_modified']) for site in sites}
+            if len(validators) == 1:
+                known_etag, known_last_modified = validators.pop()
+                if known_etag:
+                    headers['If-None-Match'] = known_etag
+                if known_last_modified:
+                    headers['If-Modified-Since'] = known_last_modified
 
             try:
-                response = self.session.get(
-                    site['url'],
-                    headers=headers,
-                    timeout=30,
-                    verify=False
-                )
-                response.raise_for_status()
+                fetched = self._fetch_body(url, headers)
+            except requests.exceptions.SSLError:
+                fetched = self._fetch_body(url.replace('https://', 'http://'), headers)
 
-                if response.encoding:
-                    content = response.text
-                else:
-                    content = response.content.decode('utf-8', errors='ignore')
+            # 304: сервер сам подтвердил, что страница не менялась
+            if fetched is None:
+                for site in sites:
+                    self.db.touch_site(site['id'])
+                logger.info(f"✅ Сайт {sites[0]['site_name']} не изменился (304)")
+                return changes
 
-            except requests.exceptions.SSLError:
-                response = self.session.get(
-                    site['url'].replace('https://', 'http://'),
-                    headers=headers,
-                    timeout=30,
-                    verify=False
-                )
-                response.raise_for_status()
-                content = response.text
+            chunks, encoding, body_hash, etag, last_modified = fetched
+
+            pending = []
+            for site in sites:
+                if etag != site['etag'] or last_modified != site['last_modified']:
+                    self.db.update_site_cache_headers(site['id'], etag, last_modified)
 
-            soup = BeautifulSoup(content, 'lxml', from_encoding='utf-8')
+                # Тело не изменилось байт в байт - разбор и дифф не нужны
+                if body_hash == site['body_hash']:
+                    self.db.touch_site(site['id'])
+                else:
+                    pending.append(site)
 
-            for element in soup(["script", "style", "meta", "link", "noscript", "iframe"]):
-                element.decompose()
+            if not pending:
+                logger.info(f"✅ Сайт {sites[0]['site_name']} не изменился")
+                return changes
 
             try:
-                text = soup.get_text()
-                lines = (line.strip() for line in text.splitlines())
-                chunks = (phrase.strip() for line in lines for phrase in line.split("  "))
-                text = ' '.join(chunk for chunk in chunks if chunk)
+                text = self._extract_text(chunks, encoding)
             except Exception as e:
-                logger.error(f"Error parsing text for {site['url']}: {e}")
-                self.db.record_error(site['id'], 'parsing_error', str(e))
-                return
+                logger.error(f"Error parsing text for {url}: {e}")
+                self._record_errors(pending, 'parsing_error', str(e))
+                return changes
 
             if not text or len(text) < 50:
-                logger.warning(f"Слишком мало текста на сайте {site['site_name']}")
-                return
-
-            current_hash = hashlib.md5(text.encode('utf-8', errors='ignore')).hexdigest()
-
-            if site['last_hash'] and current_hash != site['last_hash']:
-                logger.info(f"🔄 Обнаружены изменения на {site['site_name']}")
+                logger.warning(f"Слишком мало текста на сайте {sites[0]['site_name']}")
+                return changes
 
-                old_content = site['last_content'] or ''
-                old_content_str = old_content if isinstance(old_content, str) else str(old_content)
+            # Некриптографический хэш: для обнаружения изменений его достаточно,
+            # а считается он на порядок быстрее MD5. Храним 8 байт дайджеста
+            current_hash = xxhash.xxh3_64_digest(text.encode('utf-8', errors='ignore'))
 
-                try:
-                    changes_diff = '\n'.join(difflib.unified_diff(
-                        old_content_str.splitlines(),
-                        text.splitlines(),
-                        lineterm='',
-                        n=2
-                    ))[:5000]
-                except Exception as e:
-                    logger.error(f"Error creating diff: {e}")
-                    changes_diff = "Изменения обнаружены, но не могут быть отображены"
-
-                changes_data = {
-                    'diff': changes_diff,
-                    'old_content': old_content_str,
-                    'new_content': text,
-                    'change_type': 'content_update'
-                }
-
-                site_info = {
-                    'site_name': site['site_name'],
-                    'url': site['url']
-                }
+            for site in pending:
+                # Старые хэши (hex-строки MD5) не сравниваем: такой сайт просто
+                # получает новый хэш без ложного уведомления. Дифф строится только
+                # после несовпадения хэшей
+                if isinstance(site['last_hash'], bytes) and current_hash != site['last_hash']:
+                    logger.info(f"🔄 Обнаружены изменения на {site['site_name']}")
+                    changes.append((site, self._build_changes(site, text)))
 
-                try:
-                    asyncio.run_coroutine_threadsafe(
-                        self.notification_system.process_change(
-                            site['user_id'], site_info, changes_data
-                        ),
-                        asyncio.get_event_loop()
-                    )
-                except Exception as e:
-                    logger.error(f"Error scheduling notification: {e}")
+                self.db.update_site_hash(site['id'], current_hash, body_hash, text)
 
-            self.db.update_site_hash(site['id'], current_hash, text)
-            logger.info(f"✅ Сайт {site['site_name']} успешно проверен")
+            logger.info(f"✅ Сайт {sites[0]['site_name']} успешно проверен")
+            return changes
 
         except requests.exceptions.HTTPError as e:
             error_msg = f"HTTP {e.response.status_code}"
-            logger.warning(f"{error_msg} для {site['url']}")
-            self.db.record_error(site['id'], 'http_error', error_msg)
+            logger.warning(f"{error_msg} для {url}")
+            self._record_errors(sites, 'http_error', error_msg)
 
         except requests.exceptions.Timeout:
             error_msg = "Timeout"
-            logger.warning(f"Таймаут для {site['url']}")
-            self.db.record_error(site['id'], 'timeout', error_msg)
+            logger.warning(f"Таймаут для {url}")
+            self._record_errors(sites, 'timeout', error_msg)
 
         except requests.exceptions.ConnectionError:
             error_msg = "Connection error"
-            logger.warning(f"Ошибка соединения с {site['url']}")
-            self.db.record_error(site['id'], 'connection_error', error_msg)
+            logger.warning(f"Ошибка соединения с {url}")
+            self._record_errors(sites, 'connection_error', error_msg)
 
         except Exception as e:
             error_msg = str(e)
-            logger.error(f"❌ Ошибка проверки {site['url']}: {error_msg}")
-            self.db.record_error(site['id'], 'general_error', error_msg)
+            logger.error(f"❌ Ошибка проверки {url}: {error_msg}")
+            self._record_errors(sites, 'general_error', error_msg)
+
+        return changes
+
+    def _extract_text(self, chunks, encoding):
+        """Достает из страницы видимый текст"""
+        # Разбор напрямую через lxml, без построения дерева BeautifulSoup
+        parser = lxml.html.HTMLParser(encoding=encoding, remove_comments=True)
+        tree = lxml.html.document_fromstring(b''.join(chunks), parser=parser)
+        etree.strip_elements(tree, *_UNWANTED_TAGS, with_tail=False)
+
+        text = _INLINE_WS_RE.sub(' ', tree.text_content())
+        return _LINE_BREAK_RE.sub('\n', text).strip()
+
+    def _build_changes(self, site, text):
+        """Готовит данные об изменении страницы для системы уведомлений"""
+        old_content_str = self.db.get_site_content(site['id'])
+
+        try:
+            # difflib получает только участок между совпадающими началом и концом
+            old_lines, new_lines = _changed_window(
+                old_content_str.splitlines(), text.splitlines()
+            )
+            # unified_diff - генератор: останавливаемся, как только набрали
+            # _MAX_DIFF_CHARS, и остальные блоки изменений не вычисляются
+            diff_parts = []
+            diff_size = 0
+            for line in difflib.unified_diff(old_lines, new_lines, lineterm='', n=_DIFF_CONTEXT):
+                diff_parts.append(line)
+                diff_size += len(line) + 1
+                if diff_size >= _MAX_DIFF_CHARS:
+                    break
+            changes_diff = '\n'.join(diff_parts)[:_MAX_DIFF_CHARS]
+        except Exception as e:
+            logger.error(f"Error creating diff: {e}")
+            changes_diff = "Изменения обнаружены, но не могут быть отображены"
+
+        return {
+            'diff': changes_diff,
+            'old_content': old_content_str,
+            'new_content': text,
+            'change_type': 'content_update'
+        }
+
+    def _record_errors(self, sites, error_type, error_message):
+        # Ошибки копятся до конца прохода и пишутся одним executemany
+        self._error_buf.extend((site['id'], error_type, error_message) for site in sites)
 
 
 # ==================== ЗАПУСК СИСТЕМЫ ====================
@@ -1170,13 +1724,7 @@ def main():
         return
 
     try:
-        db = DatabaseManager()
-        bot = MonitoringBot(TELEGRAM_BOT_TOKEN, AI_TUNNEL_API_KEY)
-        monitoring_system = SmartMonitoringSystem(db, bot.notification_system)
-
-        monitoring_thread = Thread(target=monitoring_system.start_monitoring, args=(10,), daemon=True)
-        monitoring_thread.start()
-
+        bot = MonitoringBot(TELEGRAM_BOT_TOKEN, AI_TUNNEL_API_KEY, check_interval_minutes=10)
         bot.run()
 
     except KeyboardInterrupt: